@@ -1,11 +1,185 @@
+import os
+from pathlib import Path
+
 import duckdb  # type: ignore
 
 
+def configure_connection(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Tunes the connection for batch runs of this script.
+
+    NOTE: row order is only guaranteed where the queries below ask for it
+    with ORDER BY, so the parallel JSON reader does not need to preserve
+    insertion order. 'threads' and 'memory_limit' are left at DuckDB's
+    defaults, which already use all cores and 80% of the available RAM.
+    """
+    con.execute("SET preserve_insertion_order = false")
+    con.execute("SET enable_progress_bar = false")
+
+
+def list_source_files(
+    con: duckdb.DuckDBPyConnection, pattern: str, manifest: Path, refresh: bool = False
+) -> list[str]:
+    """
+    Returns the NDJSON files matching 'pattern'.
+
+    Listing a large S3 prefix is slow and rate limited, so the listing is
+    written to the local 'manifest' file and reused on later runs instead
+    of listing the bucket again. Set 'refresh' (or delete the manifest) to
+    pick up files that were added to the bucket since.
+    """
+    if manifest.exists() and not refresh:
+        return manifest.read_text().splitlines()
+
+    files = [
+        row[0]
+        for row in con.sql(
+            "SELECT file FROM glob($pattern)", params={"pattern": pattern}
+        ).fetchall()
+    ]
+    manifest.write_text("".join(f"{file}\n" for file in files))
+    return files
+
+
+def ingest_expeditions(
+    con: duckdb.DuckDBPyConnection, files: list[str], refresh: bool = False
+) -> None:
+    """
+    Loads the given NDJSON files into the 'expeditions' table.
+
+    The ingested file names are tracked in the 'ingest_meta' table, so that
+    re-running against an existing database only downloads and parses files
+    that were added since the previous run. Files are tracked by name only,
+    so set 'refresh' to rebuild the table when existing files have changed.
+
+    NOTE: the 'species_flat' table is rebuilt in the same transaction, so
+    that it can never be left behind the newly ingested files.
+    """
+    if refresh:
+        con.sql("DROP TABLE IF EXISTS ingest_meta")
+    con.sql("""
+        CREATE TABLE IF NOT EXISTS ingest_meta (
+            filename VARCHAR,
+            ingested_at TIMESTAMP WITH TIME ZONE
+        )
+    """)
+
+    ingested = {
+        row[0] for row in con.sql("SELECT filename FROM ingest_meta").fetchall()
+    }
+    new_files = [file for file in files if file not in ingested]
+    if not new_files:
+        print("No new files to ingest.")
+        return
+
+    # Append to the existing table, unless nothing was tracked as ingested
+    # yet, in which case the table is (re)created from scratch.
+    statement = (
+        "INSERT INTO expeditions"
+        if ingested
+        else "CREATE OR REPLACE TABLE expeditions AS"
+    )
+
+    con.begin()
+    con.sql(
+        statement
+        + """
+        SELECT *
+        FROM read_ndjson(
+            $files,
+            format = 'newline_delimited',
+            maximum_object_size = 67108864,
+            ignore_errors = false,
+            hive_partitioning = false,
+            filename = false,
+            columns = {
+                expedition_id: 'VARCHAR',
+                end_date: 'VARCHAR',
+                reserve: 'STRUCT(
+                    species STRUCT(
+                        "name" VARCHAR,
+                        population UBIGINT,
+                        tracking STRUCT(
+                            tagged UBIGINT,
+                            sightings STRUCT(
+                                activity VARCHAR
+                            )[]
+                        )
+                    )[]
+                )'
+            }
+        )
+        """,
+        params={"files": new_files},
+    )
+    con.sql(
+        "INSERT INTO ingest_meta SELECT unnest($files), now()",
+        params={"files": new_files},
+    )
+    create_species_flat(con)
+    con.commit()
+    print(f"Ingested {len(new_files)} new file(s).")
+
+
+def create_species_flat(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Unnests the nested species list once into a flat table, so that the
+    analytics below do not each repeat the expensive unnest of
+    'reserve.species' on the 'expeditions' table.
+
+    The latest ingest time is recorded in 'species_flat_meta', which is
+    what 'species_flat_is_fresh' checks the flat table against.
+    """
+    con.sql("""
+        CREATE OR REPLACE TABLE species_flat AS
+        SELECT
+            expedition_id,
+            s.name AS species_name,
+            s.population AS population,
+            s.tracking.tagged AS tagged,
+            s.tracking.sightings AS sightings
+        FROM expeditions, UNNEST(reserve.species) AS t(s)
+    """)
+    con.execute("""
+        CREATE OR REPLACE TABLE species_flat_meta AS
+        SELECT max(ingested_at) AS ingested_at
+        FROM ingest_meta
+    """)
+
+
+def species_flat_is_fresh(con: duckdb.DuckDBPyConnection) -> bool:
+    """
+    Returns whether the 'species_flat' table was built after the latest
+    ingest, e.g. it is not when a previous run stopped before building it.
+    """
+    tables = con.sql("""
+        SELECT table_name
+        FROM duckdb_tables()
+        WHERE table_name IN ('ingest_meta', 'species_flat', 'species_flat_meta')
+    """).fetchall()
+    if len(tables) < 3:
+        return False
+
+    result = con.sql("""
+        SELECT COUNT(*)
+        FROM species_flat_meta
+        WHERE ingested_at = (SELECT max(ingested_at) FROM ingest_meta)
+    """).fetchone()
+    return result is not None and result[0] > 0
+
+
 def compute_unique_expedition_count(con: duckdb.DuckDBPyConnection) -> int:
     """
     Determine the distinct count of expedition IDs.
     """
-    result = con.sql("SELECT COUNT(DISTINCT expedition_id) FROM expeditions").fetchone()
+    result = con.sql("""
+        SELECT COUNT(*)
+        FROM (
+            SELECT expedition_id
+            FROM expeditions
+            GROUP BY expedition_id
+        )
+    """).fetchone()
     return 0 if result is None else result[0]
 
 
@@ -18,12 +192,10 @@ def compute_unique_species_count_per_expedition(
     return con.sql("""
         SELECT
             expedition_id,
-            COUNT(DISTINCT species_name) AS count_unique_species
+            COUNT(*) AS count_unique_species
         FROM (
-            SELECT
-                expedition_id,
-                unnest(reserve.species).name AS species_name
-            FROM expeditions
+            SELECT DISTINCT expedition_id, species_name
+            FROM species_flat
         )
         GROUP BY expedition_id
     """)
@@ -38,22 +210,26 @@ def determine_tracking_issues_by_species(
     cannot be greater than the known population of that species.
     """
     return con.sql("""
-        WITH species_data AS (
-            SELECT
-                unnest(reserve.species).name AS name,
-                unnest(reserve.species).population AS population,
-                unnest(reserve.species).tracking.tagged AS tagged
-            FROM expeditions
-        )
         SELECT
             name,
             population,
             tagged,
-            ROUND(CAST(tagged AS FLOAT) / population, 2) AS ratio_tagged,
-            tagged - population AS excess_count
-        FROM species_data
-        WHERE population < tagged
-        ORDER BY ratio_tagged DESC
+            -- Integer division by a zero population gives NULL, whereas
+            -- the ratio is infinite, i.e. the worst possible tracking issue.
+            coalesce(ratio_tagged_x100 / 100, 'inf'::DOUBLE) AS ratio_tagged,
+            excess_count
+        FROM (
+            SELECT
+                species_name AS name,
+                population,
+                tagged,
+                -- Ratio rounded to two decimals, kept as a scaled integer.
+                (tagged * 100 + population // 2) // population AS ratio_tagged_x100,
+                tagged - population AS excess_count
+            FROM species_flat
+            WHERE population < tagged
+        )
+        ORDER BY population = 0 DESC, ratio_tagged_x100 DESC
     """)
 
 
@@ -66,27 +242,13 @@ def count_activity_matches_per_expedition(
     """
     return con.sql(
         """
-        WITH species_sightings AS (
-            SELECT unnest(reserve.species).tracking.sightings AS sightings,
-                   expedition_id
-            FROM expeditions
-        ),
-        activities AS (
-            SELECT unnest(sightings).activity AS activity,
-                   expedition_id
-            FROM species_sightings
-        ),
-        activity_counts AS (
-            SELECT expedition_id,
-                   COUNT(*) AS target_activity_count
-            FROM activities
-            WHERE activity = $target_activity
-            GROUP BY expedition_id
-        )
         SELECT expedition_id,
-               target_activity_count
-        FROM activity_counts
-        WHERE target_activity_count > $min_activity_count
+               SUM(
+                   len(list_filter(sightings, x -> x.activity = $target_activity))
+               )::BIGINT AS target_activity_count
+        FROM species_flat
+        GROUP BY expedition_id
+        HAVING target_activity_count > $min_activity_count
         ORDER BY target_activity_count DESC
         """,
         params={
@@ -104,15 +266,10 @@ def compute_species_population(
     """
     return con.sql("""
         SELECT
-            name,
+            species_name AS name,
             SUM(population) AS population
-        FROM (
-            SELECT
-                unnest(reserve.species).name as name,
-                unnest(reserve.species).population as population
-            FROM expeditions
-        )
-        GROUP BY name
+        FROM species_flat
+        GROUP BY species_name
         ORDER BY population DESC
     """)
 
@@ -125,38 +282,22 @@ def compute_most_common_activity_for_species(
     across all sightings and expeditions.
 
     This could probably be simplified. Here we're showing the nice
-    syntax of list comprehensions and list flattening in DuckDB.
+    syntax of list comprehensions in DuckDB.
     """
 
     return con.sql("""
-        WITH species_and_sigthtings AS (
+        WITH activities_per_expedition_and_species AS (
             SELECT
                 expedition_id,
-                end_date AS expedition_end_date,
-                unnest(reserve.species).name AS species_name,
-                unnest(reserve.species).tracking.sightings AS sightings
-            FROM expeditions
-        ),
-        activities_per_expedition_and_species AS (
-            SELECT
-                expedition_id,
-                expedition_end_date,
                 species_name,
                 [sight['activity'] FOR sight IN sightings] AS activities,
-            FROM species_and_sigthtings
-        ),
-        activities_per_species AS (
-            SELECT
-                species_name,
-                flatten(list(activities ORDER BY expedition_end_date ASC)) AS activities
-            FROM activities_per_expedition_and_species
-            GROUP BY ALL
+            FROM species_flat
         ),
         activities_unnested AS (
             SELECT
                 species_name,
                 unnest(activities) AS activity
-            FROM activities_per_species
+            FROM activities_per_expedition_and_species
         ),
         activity_counts AS (
             SELECT
@@ -168,92 +309,135 @@ def compute_most_common_activity_for_species(
         )
         SELECT
             species_name,
-            activity AS most_common_activity,
-            cnt
+            -- Highest count wins, ties are broken alphabetically by activity.
+            arg_min(activity, (-cnt, activity)) AS most_common_activity,
+            max(cnt) AS cnt
         FROM activity_counts
-        QUALIFY rank() OVER (PARTITION BY species_name ORDER BY cnt DESC, activity) = 1
+        GROUP BY species_name
         ORDER BY species_name
     """)
 
 
+def store_analytics(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Runs the analytics below and stores each result in its own
+    'result_<name>' table, writing all of them in a single transaction.
+
+    The ingest time that 'species_flat' was built from is recorded in
+    'result_meta', which is what 'results_are_fresh' checks the stored
+    results against.
+    """
+    analytics = {
+        "unique_species_count_per_expedition": (
+            compute_unique_species_count_per_expedition(con)
+        ),
+        "species_population": compute_species_population(con),
+        "tracking_issues": determine_tracking_issues_by_species(con),
+        "activity_matches": count_activity_matches_per_expedition(con, "hunting", 2),
+        "most_common_activity_per_species": (
+            compute_most_common_activity_for_species(con)
+        ),
+    }
+
+    con.begin()
+    for name, relation in analytics.items():
+        con.execute(f"DROP TABLE IF EXISTS result_{name}")
+        relation.create(f"result_{name}")
+    con.execute("""
+        CREATE OR REPLACE TABLE result_meta AS
+        SELECT ingested_at
+        FROM species_flat_meta
+    """)
+    con.commit()
+
+
+def results_are_fresh(con: duckdb.DuckDBPyConnection) -> bool:
+    """
+    Returns whether the stored 'result_<name>' tables were computed from a
+    'species_flat' table built after the latest ingest, in which case they
+    can be shown without running the analytics again.
+    """
+    tables = con.sql("""
+        SELECT table_name
+        FROM duckdb_tables()
+        WHERE table_name IN ('ingest_meta', 'species_flat_meta', 'result_meta')
+    """).fetchall()
+    if len(tables) < 3:
+        return False
+
+    result = con.sql("""
+        SELECT COUNT(*)
+        FROM result_meta
+        JOIN species_flat_meta USING (ingested_at)
+        WHERE ingested_at = (SELECT max(ingested_at) FROM ingest_meta)
+    """).fetchone()
+    return result is not None and result[0] > 0
+
+
+def show_result(
+    con: duckdb.DuckDBPyConnection, name: str, order: str | None = None
+) -> None:
+    """
+    Shows the first rows of the stored 'result_<name>' table.
+
+    NOTE: insertion order is not preserved, so the stored tables do not keep
+    the order their analytic sorted them in. Ranked results have to be read
+    back with their 'order' for the first rows to be the top ones.
+    """
+    result = con.table(f"result_{name}")
+    if order is not None:
+        result = result.order(order)
+    result.limit(20).show()
+
+
 def main():
     """
     Run main script.
     """
     print("Hello from surviving-json-jungle!")
     con = duckdb.connect("jungle.db")
+    configure_connection(con)
+
+    # REFRESH=1 re-ingests everything, RELIST=1 only lists the bucket again
+    # so that files added since the previous run are ingested.
+    refresh = os.environ.get("REFRESH") == "1"
+    relist = refresh or os.environ.get("RELIST") == "1"
+    files = list_source_files(
+        con,
+        "s3://sumeo-jungle-data-lake/jungle/*.jsonl",
+        Path("jungle_files.txt"),
+        relist,
+    )
+    ingest_expeditions(con, files, refresh)
+    if not species_flat_is_fresh(con):
+        con.begin()
+        create_species_flat(con)
+        con.commit()
 
-    con.sql("""
-        CREATE OR REPLACE TABLE expeditions AS
-        SELECT *
-        FROM read_ndjson(
-            's3://sumeo-jungle-data-lake/jungle/*.jsonl',
-            columns = {
-                expedition_id: 'VARCHAR',
-                start_date: 'VARCHAR',
-                end_date: 'VARCHAR',
-                expedition_location: 'STRUCT(latitude DOUBLE,longitude DOUBLE)',
-                reserve: 'STRUCT(
-                    "name" VARCHAR,
-                    "location" STRUCT(
-                        latitude DOUBLE,
-                        longitude DOUBLE
-                    ),
-                    species STRUCT(
-                        "name" VARCHAR,
-                        population UBIGINT,
-                        tracking STRUCT(
-                            tagged UBIGINT,
-                            sightings STRUCT(
-                                date VARCHAR,
-                                "location" STRUCT(
-                                    latitude DOUBLE,
-                                    longitude DOUBLE
-                                ),
-                                activity VARCHAR
-                            )[]
-                        )
-                    )[],
-                    environmental_conditions STRUCT(
-                        rainfall_mm STRUCT(
-                            high UBIGINT,
-                            low UBIGINT
-                        ),
-                        temperature_c STRUCT(
-                            high UBIGINT,
-                            low UBIGINT
-                        )
-                    )
-                )'
-            }
-        )
-    """)
     print(con.sql("SELECT * FROM expeditions LIMIT 10"))
 
     # Print analysis results
     print(f"Unique expedition count: {compute_unique_expedition_count(con)}")
 
-    unique_species_count_per_expedition = compute_unique_species_count_per_expedition(
-        con
-    )
+    if results_are_fresh(con):
+        print("No new data since the last run, showing stored results.")
+    else:
+        store_analytics(con)
+
     print("Species count per expedition:")
-    print(unique_species_count_per_expedition)
+    show_result(con, "unique_species_count_per_expedition")
 
-    species_population = compute_species_population(con)
     print("Species population:")
-    print(species_population)
+    show_result(con, "species_population", "population DESC")
 
-    tracking_issues = determine_tracking_issues_by_species(con)
     print("Tracking issues by species:")
-    print(tracking_issues)
+    show_result(con, "tracking_issues", "ratio_tagged DESC")
 
-    activity_matches = count_activity_matches_per_expedition(con, "hunting", 2)
     print("Activity matches per expedition:")
-    print(activity_matches)
+    show_result(con, "activity_matches", "target_activity_count DESC")
 
-    most_common_activity_per_species = compute_most_common_activity_for_species(con)
     print("Most common activities per species:")
-    print(most_common_activity_per_species)
+    show_result(con, "most_common_activity_per_species", "species_name")
 
 
 if __name__ == "__main__":
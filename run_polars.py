@@ -1,9 +1,10 @@
+from argparse import ArgumentParser
 from pathlib import Path
 from typing import Collection
 
 import polars as pl  # type: ignore
 import s3fs  # type: ignore
-from io import StringIO
+from io import BytesIO
 
 # Define types.
 # NOTE: used for convenience, as these structs are present at
@@ -16,6 +17,34 @@ StructHighLow = pl.Struct({"high": pl.Int64(), "low": pl.Int64()})
 # Define utility functions.
 
 
+def build_species_schema() -> pl.List:
+    """
+    Returns the schema of the list of species tracked in a reserve.
+    """
+    return pl.List(
+        pl.Struct(
+            {
+                "name": pl.String(),
+                "population": pl.UInt32(),
+                "tracking": pl.Struct(
+                    {
+                        "tagged": pl.UInt32(),
+                        "sightings": pl.List(
+                            pl.Struct(
+                                {
+                                    "date": pl.String(),
+                                    "location": StructLocation,
+                                    "activity": pl.String(),
+                                }
+                            )
+                        ),
+                    }
+                ),
+            }
+        )
+    )
+
+
 def build_expected_input_schema() -> pl.Schema:
     """
     Returns the schema that the input animal data is expected to have.
@@ -37,28 +66,7 @@ def build_expected_input_schema() -> pl.Schema:
                 {
                     "name": pl.String(),
                     "location": StructLocation,
-                    "species": pl.List(
-                        pl.Struct(
-                            {
-                                "name": pl.String(),
-                                "population": pl.UInt64(),
-                                "tracking": pl.Struct(
-                                    {
-                                        "tagged": pl.UInt64(),
-                                        "sightings": pl.List(
-                                            pl.Struct(
-                                                {
-                                                    "date": pl.String(),
-                                                    "location": StructLocation,
-                                                    "activity": pl.String(),
-                                                }
-                                            )
-                                        ),
-                                    }
-                                ),
-                            }
-                        )
-                    ),
+                    "species": build_species_schema(),
                     "environmental_conditions": pl.Struct(
                         {
                             "rainfall_mm": StructHighLow,
@@ -71,21 +79,40 @@ def build_expected_input_schema() -> pl.Schema:
     )
 
 
-def read_local_data(path: Path) -> pl.LazyFrame:
+def build_minimal_species_schema() -> pl.Schema:
     """
-    Helper to read in local data using the known schema.
+    Returns a narrower version of the input schema, which only has the
+    fields that the species analytics in 'summarize' make use of.
+
+    NOTE: the skipped fields (e.g. the locations and environmental
+    conditions) are then not parsed at all when reading the data, which
+    is where most of the time goes for deeply nested JSON.
+    """
+    return pl.Schema(
+        {
+            "expedition_id": pl.String(),
+            "reserve": pl.Struct({"species": build_species_schema()}),
+        }
+    )
+
+
+def read_local_data(path: Path, schema: pl.Schema | None = None) -> pl.LazyFrame:
+    """
+    Helper to read in local data using the known schema, unless a
+    narrower 'schema' is given.
     """
 
     return pl.scan_ndjson(
         path,
-        schema=build_expected_input_schema(),
+        schema=build_expected_input_schema() if schema is None else schema,
     )
 
 
-def read_cloud_data(bucket: str) -> pl.LazyFrame:
+def read_cloud_data(source: str, schema: pl.Schema | None = None) -> pl.LazyFrame:
     """
-    Helper function to read data from a public S3 bucket with
-    JSONL files using the known schema.
+    Helper function to read the JSONL files matching the 'source' glob
+    from a public S3 bucket using the known schema, unless a narrower
+    'schema' is given.
 
     NOTE: ideally, we would not need to use s3fs directly,
     but rather let Polars figure it out using `scan_ndjson`.
@@ -108,22 +135,26 @@ def read_cloud_data(bucket: str) -> pl.LazyFrame:
 
     # We set 'anon' to true since we don't need auth to read from a public bucket.
     s3 = s3fs.S3FileSystem(anon=True)
-    contents = (s3.read_text(file) for file in s3.ls(bucket) if file.endswith(".jsonl"))
-    docs = (doc for content in contents for doc in content.splitlines())
+    files = s3.glob(source)
+    # Fetch the raw bytes, since Polars parses bytes anyway and decoding
+    # them to Python strings first would only add a round-trip.
+    # NOTE: 'cat' fetches all files concurrently, rather than one by one.
+    contents = s3.cat(files).values()
 
     return pl.concat(
-        # Scanning does not add much benefit here, since we already read
-        # all the files in memory when downloading them using 's3fs'.
-        # It's only done because it should work without the prior download,
-        # and becuase a pl.LazyFrame is returned, which is expected by the
-        # subsequent functions in the script. Granted, we could also just
-        # call 'read_ndjson().lazy()' to get a pl.LazyFrame back...
-        pl.scan_ndjson(
-            StringIO(doc),
-            schema=build_expected_input_schema(),
+        # NOTE: the files are already in memory after downloading them
+        # using 's3fs', so scanning them would not add much benefit.
+        # They are read eagerly instead, since the streaming engine panics
+        # on a concatenation of several in-memory scans. A pl.LazyFrame is
+        # still returned, which is expected by the subsequent functions.
+        # Each file is read as a whole, rather than line by line, so that
+        # Polars can parse the contiguous buffer in parallel.
+        pl.read_ndjson(
+            BytesIO(content),
+            schema=build_expected_input_schema() if schema is None else schema,
         )
-        for doc in docs
-    )
+        for content in contents
+    ).lazy()
 
 
 # Define analysis functions.
@@ -131,67 +162,78 @@ def read_cloud_data(bucket: str) -> pl.LazyFrame:
 # operations that can be applied on the example dataset.
 
 
-def compute_unique_expedition_count(data: pl.LazyFrame) -> int:
+def compute_unique_expedition_count(species: pl.LazyFrame) -> pl.LazyFrame:
     """
     Determine the distinct count of expedition IDs.
 
-    NOTE: start off simple, with no nested struct querying.
+    NOTE: start off simple, with no nested struct querying. Expeditions
+    without any species still have a row in the exploded species.
     """
-    return data.select(pl.col("expedition_id").n_unique()).collect().item()
+    return species.select(pl.col("expedition_id").n_unique())
 
 
-def compute_unique_species_count_per_expedition(data: pl.LazyFrame) -> pl.LazyFrame:
+def explode_species(data: pl.LazyFrame) -> pl.LazyFrame:
     """
-    Computes the unique count of species per expedition.
+    Returns one row per species per expedition, with the species info
+    kept as a struct in the 'species' column.
 
-    NOTE: requires fetching specific fields from nested structs.
+    NOTE: exploding the species list is the most expensive step that the
+    species analytics below have in common. It's done once here, so that
+    the result can be collected and shared between them.
     """
     return data.select(
-        pl.col("expedition_id"),
-        pl.col("reserve")
-        .struct.field("species")
-        .list.eval(pl.element().struct.field("name"))
-        .list.n_unique()
-        .alias("count_unique_species"),
+        "expedition_id",
+        pl.col("reserve").struct.field("species").alias("species"),
+    ).explode("species")
+
+
+def compute_unique_species_count_per_expedition(
+    species: pl.LazyFrame,
+) -> pl.LazyFrame:
+    """
+    Computes the unique count of species per expedition.
+
+    NOTE: requires fetching specific fields from nested structs. Null
+    names, which come from exploding empty species lists, are not counted.
+    """
+    return species.group_by("expedition_id").agg(
+        count_unique_species=pl.col("species")
+        .struct.field("name")
+        .drop_nulls()
+        .n_unique()
     )
 
 
-def compute_species_population(data: pl.LazyFrame) -> pl.LazyFrame:
+def compute_species_population(species: pl.LazyFrame) -> pl.LazyFrame:
     """
     Computes the known population of all species across all expeditions.
 
-    NOTE: uses 'explode' to unnest a struct field and then groups by
-    some of its keys.
+    NOTE: takes the exploded species from 'explode_species', fetches some
+    of their struct fields and then groups by them.
     """
     return (
-        data.select(
-            pl.col("reserve")
-            .struct.field("species")
-            .list.explode()
-            .struct.field("name", "population")
-        )
+        species.select(pl.col("species").struct.field("name", "population"))
         .group_by("name")
-        .agg(pl.sum("population"))
+        # Sum in 64 bits, since a UInt32 sum would silently wrap around.
+        .agg(pl.col("population").cast(pl.UInt64).sum())
         .sort("population", descending=True)
     )
 
 
-def determine_tracking_issues_by_species(data: pl.LazyFrame) -> pl.LazyFrame:
+def determine_tracking_issues_by_species(species: pl.LazyFrame) -> pl.LazyFrame:
     """
     Determines the species for which tracking issues may exist/
     Uses the heuristic that the 'tagged' individuals in a sighting
     cannot be greater than the known population of that species.
 
-    NOTE: combines filtering and unnesting.
+    NOTE: combines filtering and fetching fields from nested structs.
     """
     return (
-        # Get the species info in an unnsted view.
-        data.select(
-            pl.col("reserve").struct.field("species").list.explode().struct.unnest()
-        )
-        # Get the tagged field.
-        .with_columns(
-            pl.col("tracking").struct.field("tagged").alias("tagged"),
+        # Get only the species fields that are needed, so that the large
+        # 'sightings' lists are not carried along.
+        species.select(
+            pl.col("species").struct.field("name", "population"),
+            tagged=pl.col("species").struct.field("tracking").struct.field("tagged"),
         )
         # Filter for records that have tracking > population
         .filter(pl.col("population") < pl.col("tagged"))
@@ -202,7 +244,6 @@ def determine_tracking_issues_by_species(data: pl.LazyFrame) -> pl.LazyFrame:
         )
         # Perform final pre-display stuff.
         .sort("ratio_tagged", descending=True)
-        .select("name", "population", "tagged", "ratio_tagged", "excess_count")
     )
 
 
@@ -229,43 +270,42 @@ def flatten(data: pl.LazyFrame) -> pl.LazyFrame:
 
 
 def count_activity_matches_per_expedition(
-    data: pl.LazyFrame, *, target_activity: str, min_activity_count: int
+    species: pl.LazyFrame, *, target_activity: str, min_activity_count: int
 ) -> pl.LazyFrame:
     """
     Fetches the expediton ids in which the target activity was sighted
     for any tracked species at least 'min_activity_count' times.
 
-    NOTE: uses list flattening and counting operations on list types.
+    NOTE: explodes the sightings and counts the matching activities per
+    expedition in a group by, rather than evaluating lists row by row.
     """
     return (
-        data.select(
+        species.select(
             "expedition_id",
-            sighted_activities=pl.col("reserve")
-            .struct.field("species")
-            .list.eval(
-                pl.element()
-                .struct.field("tracking")
-                .struct.field("sightings")
-                .list.eval(pl.element().struct.field("activity"))
-                .flatten()
-            ),
+            sighting=pl.col("species")
+            .struct.field("tracking")
+            .struct.field("sightings"),
         )
-        .with_columns(
-            target_activity_counts=pl.col("sighted_activities").list.count_matches(
-                target_activity
-            ),
+        .explode("sighting")
+        .group_by("expedition_id")
+        .agg(
+            target_activity_counts=(
+                pl.col("sighting").struct.field("activity") == target_activity
+            ).sum()
         )
         .filter(pl.col("target_activity_counts") > pl.lit(min_activity_count))
     )
 
 
 def filter_for_species_by_name(
-    data: pl.LazyFrame, target_species: Collection[str]
+    species: pl.LazyFrame, target_species: Collection[str]
 ) -> pl.LazyFrame:
     """
     Filters for all species info given their name across all expeditions.
 
-    NOTE: showcases filtering by element values in a list of structs.
+    NOTE: showcases filtering by field values of the exploded species structs.
+    The species names in the data are lowercase, so only the (few) target
+    names are lowercased, rather than every name in the data.
 
     FIXME: this returns duplicates, likely due to the randomness of input data.
     See below example when running on S3 dataset.
@@ -281,111 +321,97 @@ def filter_for_species_by_name(
     └─────────────┴────────────┴────────┴─────────────────────────────────┘
     """
 
+    target_names = [name.lower() for name in target_species]
+
     return (
-        data.select(
-            species=pl.col("reserve")
-            .struct.field("species")
-            .list.eval(
-                pl.element().filter(
-                    pl.element()
-                    .struct.field("name")
-                    .str.to_lowercase()
-                    .is_in(target_species)
-                )
-            )
-        )
-        .filter(pl.col("species").list.len() > 0)
-        .select(pl.col("species").flatten().struct.unnest())
+        species.filter(pl.col("species").struct.field("name").is_in(target_names))
+        .select(pl.col("species").struct.unnest())
         .with_columns(pl.col("tracking").struct.unnest())
         .select("name", "population", "tagged", "sightings")
     )
 
 
-def compute_most_common_activity_per_species(data: pl.LazyFrame) -> pl.LazyFrame:
+def compute_most_common_activity_per_species(species: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute the most common activity per species across all expeditions.
     This showcases complex querying patterns that can be used in Polars,
-    such as list / struct unnesting or exploding, list mapping using
-    list.eval(pl.element()...), filtering over partitions, similar to
-    window functions, and value counts.
+    such as struct field access, exploding lists of structs, counting
+    with a group by, and filtering over partitions, similar to window
+    functions.
     """
     return (
-        (
-            data.select(
-                "expedition_id",
-                pl.col("end_date").alias("expedition_end_date"),
-                pl.col("reserve").struct.field("species").alias("species"),
-            )
-            .explode("species")
-            .unnest("species")
-        )
-        .select(
-            "expedition_id",
-            "expedition_end_date",
-            pl.col("name").alias("species_name"),
-            pl.col("tracking")
-            .struct.field("sightings")
-            .list.eval(pl.element().struct.field("activity"))
-            .alias("activities"),
+        species.select(
+            species_name=pl.col("species").struct.field("name"),
+            sighting=pl.col("species")
+            .struct.field("tracking")
+            .struct.field("sightings"),
         )
-        .sort("species_name", "expedition_end_date", "expedition_id")
-        .group_by("species_name", maintain_order=True)
-        .agg(
-            pl.concat_list("activities")
-            .flatten()
-            .explode()
-            .value_counts()
-            .alias("activity_counts")
-        )
-        .explode("activity_counts")
-        .unnest("activity_counts")
+        .explode("sighting")
+        .group_by("species_name", pl.col("sighting").struct.field("activity"))
+        .len("count")
         .filter(pl.col("count") == pl.max("count").over("species_name"))
-        .select("species_name", pl.col("activities").alias("activity"), "count")
+        .sort("species_name", "activity")
     )
 
 
+@pl.Config(tbl_rows=100, tbl_width_chars=1000)
 def summarize(data: pl.LazyFrame) -> None:
     """
     Print data summaries by applying multiple analytical functions.
-    """
-    with pl.Config() as cfg:
-        cfg.set_tbl_rows(100)
-        cfg.set_tbl_width_chars(1000)
 
-        print(f"Unique expedition count: {compute_unique_expedition_count(data)}")
-
-        print(
-            f"Unique species count: {compute_unique_species_count_per_expedition(data).collect()}"
-        )
-
-        print(compute_species_population(data).collect())
-
-        print(determine_tracking_issues_by_species(data).collect())
-
-        print(
-            count_activity_matches_per_expedition(
-                data, target_activity="hunting", min_activity_count=2
-            ).collect()
-        )
-
-        print(filter_for_species_by_name(data, ["polyphemus", "dromedarius"]).collect())
+    NOTE: the exploded species are collected once up front, so that all
+    analytics start from them, rather than each reading and parsing the
+    source data again. The analytics are then collected together, which
+    lets Polars run them in parallel, and printing only starts once every
+    summary has been computed.
+    """
+    species = explode_species(data).collect(streaming=True).lazy()
+
+    summaries = {
+        "Unique species count": compute_unique_species_count_per_expedition(species),
+        "Species population": compute_species_population(species),
+        "Tracking issues by species": determine_tracking_issues_by_species(species),
+        "Activity matches per expedition": count_activity_matches_per_expedition(
+            species, target_activity="hunting", min_activity_count=2
+        ),
+        "Species by name": filter_for_species_by_name(
+            species, ["polyphemus", "dromedarius"]
+        ),
+        "Most common activity per species": compute_most_common_activity_per_species(
+            species
+        ),
+    }
+    unique_expedition_count, *frames = pl.collect_all(
+        [compute_unique_expedition_count(species), *summaries.values()],
+        streaming=True,
+    )
 
-        print(
-            "Most common activity per species:",
-            compute_most_common_activity_per_species(data).collect(),
-        )
+    print(f"Unique expedition count: {unique_expedition_count.item()}")
+    for label, frame in zip(summaries, frames):
+        print(f"{label}:", frame)
 
 
 def main():
     """
     Run main script.
     """
+    parser = ArgumentParser(description="Run the Polars analytics on the jungle data.")
+    parser.add_argument(
+        "--source",
+        default="s3://sumeo-jungle-data-lake/jungle/*.jsonl",
+        help="S3 glob or local path of the JSONL data, e.g. 'data/sample.jsonl'.",
+    )
+    args = parser.parse_args()
+
     print("Hello from surviving-json-jungle!")
 
-    # ldf = read_local_data(
-    #     Path("data/sample.jsonl")
-    # )  # uncomment to run with local data.
-    ldf = read_cloud_data("s3://sumeo-jungle-data-lake/jungle/")
+    # Only the species analytics are run, so skip parsing the other fields.
+    schema = build_minimal_species_schema()
+
+    if args.source.startswith("s3://"):
+        ldf = read_cloud_data(args.source, schema)
+    else:
+        ldf = read_local_data(Path(args.source), schema)
     print(ldf.sort("expedition_id").limit(10).collect())
 
     summarize(ldf)